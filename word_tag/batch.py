@@ -0,0 +1,449 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author: David Wong <davidwong.xc@gmail.com>
+License: 3 clause BSD license
+
+This module contains the code for tagging large corpora in batch jobs.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import io
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from word_tag.business import tag_text, merge_counts, tokenize_text, tag_tokens, count_tags, join_tagged_tokens
+from word_tag.fileutils import read_json, write_json_atomic
+from word_tag.profiling import MemoryProfiler
+
+
+class CorpusJob(object):
+    """Tags a corpus and writes the tagged text of each document to an output
+    file, one JSON object per line. Progress is checkpointed periodically so a
+    job that is stopped part way through resumes where the last checkpoint
+    left off, without tagging or counting any document twice."""
+
+    def __init__(self, output_path, checkpoint_path=None, checkpoint_every=1000, checkpoint_interval=None,
+                 tag_function=tag_text):
+        """A checkpoint is written after every checkpoint_every documents, and also
+        after checkpoint_interval seconds if that is given. Larger values
+        lower the checkpoint overhead but lose more work when a job stops.
+        tag_function can be replaced with MemoryProfiler().tag_text to
+        profile the job's memory use."""
+
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+        self.ids_path = self.checkpoint_path + ".ids"
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.tag_function = tag_function
+        self.total_counts = collections.Counter()
+        self.completed = set()
+        self.stats = {}
+
+    def run(self, documents):
+        """Tags documents, an iterable of (document id, text) pairs, and returns
+        the merged tag counts for the whole corpus. Document ids must be
+        unique strings or integers."""
+
+        state = read_json(self.checkpoint_path, default={})
+        output_offset = state.get('output_offset', 0)
+        ids_offset = state.get('ids_offset', 0)
+        self.total_counts = collections.Counter(state.get('counts', {}))
+        self.stats = dict(documents_tagged=0, documents_skipped=0, checkpoints=0,
+                          checkpoint_seconds=0.0, total_seconds=0.0)
+        start_time = time.time()
+
+        for path, offset in ((self.ids_path, ids_offset), (self.output_path, output_offset)):
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size < offset:
+                raise ValueError("%s is %d bytes but the checkpoint %s expects at least %d, so the job cannot "
+                                 "be resumed from it" % (path, size, self.checkpoint_path, offset))
+
+        with self.open_truncated(self.ids_path, ids_offset) as ids_file:
+            ids_file.seek(0)
+            self.completed = set(json.loads(line.decode('utf-8')) for line in ids_file)
+
+            with self.open_truncated(self.output_path, output_offset) as output_file:
+                since_checkpoint = 0
+                last_checkpoint = time.time()
+                for doc_id, text in documents:
+                    if doc_id in self.completed:
+                        self.stats['documents_skipped'] += 1
+                        continue
+
+                    tagged_text, counter_tags = self.tag_function(text, use_averages=False)
+                    output_file.write(json.dumps({'id': doc_id, 'tagged_text': tagged_text}).encode('utf-8') + b"\n")
+                    ids_file.write(json.dumps(doc_id).encode('utf-8') + b"\n")
+                    merge_counts(self.total_counts, counter_tags)
+                    self.completed.add(doc_id)
+                    self.stats['documents_tagged'] += 1
+                    since_checkpoint += 1
+
+                    if since_checkpoint >= self.checkpoint_every or (self.checkpoint_interval is not None and
+                                                                     time.time() - last_checkpoint >= self.checkpoint_interval):
+                        self.checkpoint(output_file, ids_file)
+                        since_checkpoint = 0
+                        last_checkpoint = time.time()
+
+                self.checkpoint(output_file, ids_file)
+
+        self.stats['total_seconds'] = time.time() - start_time
+        return self.total_counts
+
+    def checkpoint(self, output_file, ids_file):
+        """Flushes the output to disk and then records how far it got. Anything
+        written after the last checkpoint is discarded when the job resumes."""
+
+        start_time = time.time()
+        for open_file in (output_file, ids_file):
+            open_file.flush()
+            os.fsync(open_file.fileno())
+        write_json_atomic(self.checkpoint_path, {'output_offset': output_file.tell(),
+                                                 'ids_offset': ids_file.tell(),
+                                                 'counts': dict(self.total_counts)})
+        self.stats['checkpoints'] += 1
+        self.stats['checkpoint_seconds'] += time.time() - start_time
+
+    def checkpoint_overhead(self):
+        """Returns the fraction of the last run's time spent writing checkpoints."""
+
+        if not self.stats.get('total_seconds'):
+            return 0.0
+        return self.stats['checkpoint_seconds'] / self.stats['total_seconds']
+
+    @staticmethod
+    def open_truncated(path, offset):
+        """Opens a file for appending after cutting it back to offset bytes.
+        The file must already be at least offset bytes long."""
+
+        open_file = io.open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        open_file.truncate(offset)
+        open_file.seek(offset)
+        return open_file
+
+
+#The taggers NLTK uses look at the two previous tags and at the words up to
+#two places either side of the word being tagged.
+TAG_HISTORY = 2
+WORD_CONTEXT = 2
+
+
+def estimate_cost(text):
+    """Estimates the time needed to tag text. Tagging time grows about
+    linearly with length, so the number of characters is used."""
+
+    return len(text)
+
+
+def split_tokens(tokens, max_chars, overlap=20):
+    """Splits the tokens of a long document into pieces of about max_chars
+    characters. Returns (start, end, left, right) tuples. A piece is tagged as
+    tokens[start - left:end + right], where the left and right tokens are
+    context from the neighbouring pieces that is tagged again and then dropped."""
+
+    if overlap < TAG_HISTORY:
+        raise ValueError("overlap must be at least %d tokens" % TAG_HISTORY)
+
+    bounds = []
+    start = 0
+    chars = 0
+    for end, token in enumerate(tokens, 1):
+        chars += len(token) + 1
+        if chars >= max_chars:
+            bounds.append((start, end))
+            start = end
+            chars = 0
+    if start < len(tokens):
+        bounds.append((start, len(tokens)))
+    return [(start, end, min(overlap, start), min(WORD_CONTEXT, len(tokens) - end)) for start, end in bounds]
+
+
+def join_pieces(bounds, tagged_pieces):
+    """Joins the tagged pieces of a document, dropping their context tokens.
+    A piece matches tagging the whole document if the tags it gave the last
+    two context tokens match the tags already joined, because from there the
+    tagger sees the same words and tags. Returns None if a piece does not match."""
+
+    tagged_tokens = []
+    for (start, end, left, right), tagged in zip(bounds, tagged_pieces):
+        if left < start and list(tagged[left - TAG_HISTORY:left]) != tagged_tokens[start - TAG_HISTORY:start]:
+            return None
+        tagged_tokens.extend(tagged[left:len(tagged) - right])
+    return tagged_tokens
+
+
+def make_work_units(documents, unit_chars, overlap=20, split=True):
+    """Packs documents into work units of about unit_chars characters. If split
+    is True, longer documents are tokenized and split into pieces with
+    split_tokens. Returns a list of units, each a list of (document id, piece
+    number, text or tokens) tuples with the largest unit first, and a dict
+    from the id of each split document to its tokens and piece bounds."""
+
+    pieces = []
+    splits = {}
+    for doc_id, text in documents:
+        if split and estimate_cost(text) > unit_chars:
+            tokens = tokenize_text(text)
+            bounds = split_tokens(tokens, unit_chars, overlap)
+            splits[doc_id] = (tokens, bounds)
+            pieces.extend((doc_id, number, tokens[start - left:end + right])
+                          for number, (start, end, left, right) in enumerate(bounds))
+        else:
+            pieces.append((doc_id, 0, text))
+    pieces.sort(key=lambda piece: _piece_cost(piece[2]), reverse=True)
+
+    units = []
+    unit = []
+    unit_cost = 0
+    for piece in pieces:
+        cost = _piece_cost(piece[2])
+        if unit and unit_cost + cost > unit_chars:
+            units.append(unit)
+            unit = []
+            unit_cost = 0
+        unit.append(piece)
+        unit_cost += cost
+    if unit:
+        units.append(unit)
+    return units, splits
+
+
+def _piece_cost(payload):
+    if isinstance(payload, list):
+        return sum(len(i) + 1 for i in payload)
+    return estimate_cost(payload)
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    rank = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))]
+    return {'p50': rank(0.5), 'p95': rank(0.95), 'p99': rank(0.99), 'max': values[-1]}
+
+
+def _scheduled_worker(worker, task_queues, result_queue, profile_memory):
+    """Tags the units in this worker's queue until it reaches its None marker,
+    then takes units from the other workers' queues until they are empty."""
+
+    profiler = MemoryProfiler() if profile_memory else None
+    tag_function = profiler.tag_text if profile_memory else tag_text
+
+    def tag_unit(unit_id, unit, stolen):
+        try:
+            start_time = time.time()
+            results = []
+            for doc_id, number, payload in unit:
+                if isinstance(payload, list):
+                    results.append((doc_id, number, tag_tokens(payload)))
+                else:
+                    results.append((doc_id, number, tag_function(payload, use_averages=False)))
+                    if profile_memory:
+                        profiler.records[-1]['document'] = doc_id
+            records = []
+            if profile_memory:
+                records, profiler.records = profiler.records, []
+            result_queue.put((unit_id, worker, stolen, results, time.time() - start_time, records))
+            return True
+        except Exception:
+            result_queue.put((unit_id, worker, stolen, None, traceback.format_exc(), []))
+            return False
+
+    own_queue = task_queues[worker]
+    while True:
+        item = own_queue.get()
+        if item is None:
+            break
+        if not tag_unit(item[0], item[1], False):
+            return
+
+    other_queues = task_queues[worker + 1:] + task_queues[:worker]
+    took_unit = True
+    while took_unit:
+        took_unit = False
+        for other_queue in other_queues:
+            try:
+                item = other_queue.get_nowait()
+            except queue.Empty:
+                continue
+            if item is None:
+                #That worker has not reached its marker yet, so give it back.
+                other_queue.put(None)
+                continue
+            took_unit = True
+            if not tag_unit(item[0], item[1], True):
+                return
+
+
+class BatchScheduler(object):
+    """Tags a batch of documents of mixed sizes with several worker processes.
+    Long documents are split into pieces and short ones are packed together,
+    so every work unit has about the same number of characters. The units
+    are dealt largest first to a queue for each worker, always to the worker
+    with the least work queued. A worker that empties its own queue takes
+    units from the front of the other workers' queues.
+
+    Splitting does not change the results. The pieces of a document overlap,
+    and the tagged overlap is checked against the piece before it. If a check
+    fails, the whole document is tagged again in this process. Documents are
+    tokenized for splitting in this process too, before the workers start,
+    and the report gives the time spent on both."""
+
+    def __init__(self, workers=None, unit_chars=20000, overlap=20, profile_memory=False, poll_seconds=1.0):
+        """overlap is the number of tokens of context before each piece of a split
+        document. If profile_memory is True, documents are not split, the
+        workers record the memory used by each document, and the records are
+        collected in self.memory_profiler. poll_seconds is how often the
+        workers are checked while waiting for results."""
+
+        self.workers = workers or multiprocessing.cpu_count()
+        self.unit_chars = unit_chars
+        self.overlap = overlap
+        self.profile_memory = profile_memory
+        self.poll_seconds = poll_seconds
+        self.memory_profiler = MemoryProfiler()
+        self.report = {}
+
+    def run(self, documents):
+        """Tags documents, a list of (document id, text) pairs with unique ids.
+        Returns a list of (document id, tagged text, tag counts) in the order
+        of documents, and stores a scheduling report in self.report. Raises
+        RuntimeError if tagging fails or a worker process dies, for example
+        because it ran out of memory."""
+
+        documents = list(documents)
+        start_time = time.time()
+        units, splits = make_work_units(documents, self.unit_chars, self.overlap, split=not self.profile_memory)
+
+        task_queues = [multiprocessing.Queue() for i in range(self.workers)]
+        queued_cost = [0] * self.workers
+        for unit_id, unit in enumerate(units):
+            worker = queued_cost.index(min(queued_cost))
+            task_queues[worker].put((unit_id, unit))
+            queued_cost[worker] += sum(_piece_cost(piece[2]) for piece in unit)
+        for task_queue in task_queues:
+            task_queue.put(None)
+
+        result_queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_scheduled_worker,
+                                             args=(i, task_queues, result_queue, self.profile_memory))
+                     for i in range(self.workers)]
+
+        pieces = collections.defaultdict(dict)
+        pieces_left = collections.Counter(piece[0] for unit in units for piece in unit)
+        unit_seconds = []
+        document_seconds = {}
+        busy_seconds = [0.0] * self.workers
+        units_done = [0] * self.workers
+        units_stolen = [0] * self.workers
+        self.memory_profiler.records = []
+        #Tokenizing and splitting long documents, before any worker is running.
+        split_seconds = time.time() - start_time
+
+        for process in processes:
+            process.start()
+        try:
+            while sum(units_done) < len(units):
+                try:
+                    unit_id, worker, stolen, results, seconds, records = result_queue.get(timeout=self.poll_seconds)
+                except queue.Empty:
+                    self.check_workers(processes)
+                    continue
+                if results is None:
+                    raise RuntimeError("Tagging failed in worker %d:\n%s" % (worker, seconds))
+                busy_seconds[worker] += seconds
+                units_done[worker] += 1
+                units_stolen[worker] += stolen
+                unit_seconds.append(seconds)
+                self.memory_profiler.records.extend(records)
+                for doc_id, number, result in results:
+                    pieces[doc_id][number] = result
+                    pieces_left[doc_id] -= 1
+                    if pieces_left[doc_id] == 0:
+                        document_seconds[doc_id] = time.time() - start_time
+        finally:
+            for process in processes:
+                process.join(self.poll_seconds)
+                if process.is_alive():
+                    process.terminate()
+
+        join_start_time = time.time()
+        results = []
+        retagged = 0
+        for doc_id, text in documents:
+            if doc_id in splits:
+                tokens, bounds = splits[doc_id]
+                tagged_tokens = join_pieces(bounds, [pieces[doc_id][i] for i in range(len(bounds))])
+                if tagged_tokens is None:
+                    tagged_tokens = tag_tokens(tokens)
+                    retagged += 1
+                    document_seconds[doc_id] = time.time() - start_time
+                results.append((doc_id, join_tagged_tokens(tagged_tokens), count_tags(tagged_tokens, False)))
+            else:
+                tagged_text, counter_tags = pieces[doc_id][0]
+                results.append((doc_id, tagged_text, counter_tags))
+
+        #The workers are idle while the coordinator splits and joins, so
+        #utilisation is measured over the whole run.
+        end_time = time.time()
+        wall_seconds = end_time - start_time
+        self.report = {
+            'documents': len(documents),
+            'split_documents': len(splits),
+            'retagged_documents': retagged,
+            'units': len(units),
+            'wall_seconds': wall_seconds,
+            'split_seconds': split_seconds,
+            'join_seconds': end_time - join_start_time,
+            'workers': [{'units': units_done[i], 'stolen': units_stolen[i], 'busy_seconds': busy_seconds[i],
+                         'utilisation': busy_seconds[i] / wall_seconds if wall_seconds else 0.0}
+                        for i in range(self.workers)],
+            'unit_seconds': _percentiles(unit_seconds),
+            'document_seconds': _percentiles(list(document_seconds.values())),
+        }
+        self.report['utilisation'] = sum(i['utilisation'] for i in self.report['workers']) / self.workers
+        return results
+
+    @staticmethod
+    def check_workers(processes):
+        """Raises RuntimeError if a worker died, or if every worker has exited
+        while units are still waiting for results."""
+
+        for number, process in enumerate(processes):
+            if process.exitcode not in (None, 0):
+                raise RuntimeError("Worker %d exited with code %d before the batch was finished"
+                                   % (number, process.exitcode))
+        if all(process.exitcode == 0 for process in processes):
+            raise RuntimeError("The workers exited before the batch was finished")
+
+    def report_text(self):
+        """Returns the scheduling report of the last run as readable text."""
+
+        lines = ["%d documents (%d split, %d tagged again) in %d units, %.2f seconds, mean utilisation %.0f%%" %
+                 (self.report['documents'], self.report['split_documents'], self.report['retagged_documents'],
+                  self.report['units'], self.report['wall_seconds'], 100 * self.report['utilisation']),
+                 "coordinator: splitting %.2f seconds, joining and tagging again %.2f seconds" %
+                 (self.report['split_seconds'], self.report['join_seconds'])]
+        for number, worker in enumerate(self.report['workers']):
+            lines.append("worker %d: %d units (%d taken from other workers), busy %.2f seconds, utilisation %.0f%%" %
+                         (number, worker['units'], worker['stolen'], worker['busy_seconds'], 100 * worker['utilisation']))
+        for name in ('unit_seconds', 'document_seconds'):
+            latency = self.report[name]
+            if latency:
+                lines.append("%s: p50 %.3f, p95 %.3f, p99 %.3f, max %.3f" %
+                             (name, latency['p50'], latency['p95'], latency['p99'], latency['max']))
+        return "\n".join(lines)
@@ -5,7 +5,8 @@
 Author: David Wong <davidwong.xc@gmail.com>
 License: 3 clause BSD license
 
-This module only contains the text tagging function right now.
+This module contains the text tagging function and helpers for
+combining tag counts from several texts.
 
 """
 
@@ -18,36 +19,68 @@ import nltk
 
 def tag_text(text, use_averages):
     
-        text = text
-        tokens = nltk.word_tokenize(text)
-        tagged_tokens = nltk.pos_tag(tokens)
-        
-        list_tagged_tokens = ["/".join(i) for i in tagged_tokens]
-        tagged_text = " ".join(list_tagged_tokens)
-        
-        counter_tags = collections.Counter()
-        words = 0
-        sentences = 0
-        
-        for pairs in tagged_tokens:
-            counter_tags[pairs[1]] += 1
-            if pairs[1] != '"' and pairs[1] != '\'\'' and pairs[1] != '``' and pairs[1] != '.' and pairs[1] != ',':
-                words += 1
-            if '.' in pairs[0] or '?' in pairs[0] or '!' in pairs[0]:
-                sentences += 1
-        
-        #Check if option is selected to show averages per sentence.
-                
-        if use_averages:
-            sentences = float(sentences)
-            if sentences != 0:
-                for key in counter_tags:
-                    counter_tags[key] /= sentences
-                words /= sentences
-            
-                
-        counter_tags['words'] = words
-        counter_tags['sentences'] = sentences
-        
-                
-        return tagged_text, counter_tags
\ No newline at end of file
+    tokens = tokenize_text(text)
+    tagged_tokens = tag_tokens(tokens)
+    counter_tags = count_tags(tagged_tokens, use_averages)
+    tagged_text = join_tagged_tokens(tagged_tokens)
+    return tagged_text, counter_tags
+
+
+#The stages of tag_text are separate functions so they can be profiled one at a time.
+
+def tokenize_text(text):
+    return nltk.word_tokenize(text)
+
+
+def tag_tokens(tokens):
+    return nltk.pos_tag(tokens)
+
+
+def count_tags(tagged_tokens, use_averages):
+    
+    counter_tags = collections.Counter()
+    words = 0
+    sentences = 0
+    
+    for pairs in tagged_tokens:
+        counter_tags[pairs[1]] += 1
+        if pairs[1] != '"' and pairs[1] != '\'\'' and pairs[1] != '``' and pairs[1] != '.' and pairs[1] != ',':
+            words += 1
+        if '.' in pairs[0] or '?' in pairs[0] or '!' in pairs[0]:
+            sentences += 1
+    
+    #Check if option is selected to show averages per sentence.
+    if use_averages:
+        sentences = float(sentences)
+        if sentences != 0:
+            for key in counter_tags:
+                counter_tags[key] /= sentences
+            words /= sentences
+    
+    counter_tags['words'] = words
+    counter_tags['sentences'] = sentences
+    return counter_tags
+
+
+def join_tagged_tokens(tagged_tokens):
+    return " ".join(["/".join(i) for i in tagged_tokens])
+
+
+def merge_counts(total_counts, counter_tags):
+    """Adds the tag counts for one text to a running total.
+    Counts should be totals, not averages per sentence."""
+    
+    for key, value in counter_tags.items():
+        total_counts[key] += value
+    return total_counts
+
+
+def subtract_counts(total_counts, counter_tags):
+    """Removes the tag counts for one text from a running total.
+    Tags whose count drops to zero are removed from the total."""
+    
+    for key, value in counter_tags.items():
+        total_counts[key] -= value
+        if total_counts[key] == 0:
+            del total_counts[key]
+    return total_counts
@@ -0,0 +1,318 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author: David Wong <davidwong.xc@gmail.com>
+License: 3 clause BSD license
+
+This module contains a work queue for tagging a corpus on several machines
+that share a filesystem. The work directory has three folders:
+
+    pending  - shards written by the coordinator that nobody has claimed
+    claimed  - shards a worker is tagging, named after the worker
+    results  - tag counts (shard-N.json) and tagged text (shard-N.tagged.jsonl)
+               for each finished shard, and memory profiles
+               (shard-N.memory.json) if the workers profile memory. A shard
+               that could not be tagged is moved here as shard-N.failed.json
+               with the error in shard-N.error; moving it back to pending as
+               shard-N.json tags it again.
+
+Workers claim a shard by renaming it from pending to claimed, which only one
+worker can do. While a worker tags a shard, a heartbeat thread touches the
+claim several times per lease, and claims that have not been touched for
+lease_seconds are put back in pending. The age of a claim is measured with
+the shared filesystem's clock, not the local one, so the clocks of the
+machines do not need to agree.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import io
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+
+from word_tag.business import tag_text, merge_counts
+from word_tag.fileutils import read_json, write_json_atomic
+from word_tag.profiling import MemoryProfiler
+
+PENDING = "pending"
+CLAIMED = "claimed"
+RESULTS = "results"
+
+
+def write_shards(work_dir, documents, shard_size=1000):
+    """Splits documents, an iterable of (document id, text) pairs, into
+    shards of shard_size documents and queues them in work_dir.
+    Returns the names of the shards."""
+
+    for folder in (PENDING, CLAIMED, RESULTS):
+        if not os.path.isdir(os.path.join(work_dir, folder)):
+            os.makedirs(os.path.join(work_dir, folder))
+
+    shard_names = []
+    shard = []
+    for doc_id, text in documents:
+        shard.append([doc_id, text])
+        if len(shard) == shard_size:
+            shard_names.append(_write_shard(work_dir, len(shard_names), shard))
+            shard = []
+    if shard:
+        shard_names.append(_write_shard(work_dir, len(shard_names), shard))
+
+    write_json_atomic(os.path.join(work_dir, "shards.json"), shard_names)
+    return shard_names
+
+
+def _write_shard(work_dir, number, shard):
+    shard_name = "shard-%06d.json" % number
+    write_json_atomic(os.path.join(work_dir, PENDING, shard_name), shard)
+    return shard_name
+
+
+def _tagged_name(shard_name):
+    return shard_name.replace(".json", ".tagged.jsonl")
+
+
+def _memory_name(shard_name):
+    return shard_name.replace(".json", ".memory.json")
+
+
+def _error_name(shard_name):
+    return shard_name.replace(".json", ".error")
+
+
+def _failed_name(shard_name):
+    return shard_name.replace(".json", ".failed.json")
+
+
+def _filesystem_time(work_dir):
+    """Returns the current time according to the filesystem holding work_dir,
+    which is the clock that sets the modification times of claims."""
+
+    clock_path = os.path.join(work_dir, ".clock-%s-%d" % (socket.gethostname(), os.getpid()))
+    with open(clock_path, 'wb'):
+        pass
+    try:
+        return os.path.getmtime(clock_path)
+    finally:
+        os.remove(clock_path)
+
+
+def requeue_expired(work_dir, lease_seconds):
+    """Moves claims that have not been touched for lease_seconds back to
+    pending, so shards held by a worker that died are tagged again.
+    Returns the number of shards requeued."""
+
+    requeued = 0
+    now = _filesystem_time(work_dir)
+    claimed_dir = os.path.join(work_dir, CLAIMED)
+    for claim_name in os.listdir(claimed_dir):
+        claim_path = os.path.join(claimed_dir, claim_name)
+        shard_name = claim_name.split("@")[0]
+        try:
+            if now - os.path.getmtime(claim_path) > lease_seconds:
+                os.rename(claim_path, os.path.join(work_dir, PENDING, shard_name))
+                requeued += 1
+        except OSError:
+            #The worker finished the shard or another process requeued it.
+            pass
+    return requeued
+
+
+def reduce_results(work_dir, output_path=None):
+    """Merges the tag counts of every shard into corpus totals. If output_path is
+    given, the tagged text of every shard is joined into that file in shard
+    order. Raises ValueError if some shards could not be tagged or have not
+    been tagged yet."""
+
+    shard_names = read_json(os.path.join(work_dir, "shards.json"), default=[])
+    failed = [i for i in shard_names if os.path.exists(os.path.join(work_dir, RESULTS, _error_name(i)))]
+    if failed:
+        raise ValueError("%d of %d shards could not be tagged, see the .error files in %s: %s"
+                         % (len(failed), len(shard_names), os.path.join(work_dir, RESULTS), ", ".join(failed)))
+    missing = [i for i in shard_names if not os.path.exists(os.path.join(work_dir, RESULTS, i))]
+    if missing:
+        raise ValueError("%d of %d shards have no results yet" % (len(missing), len(shard_names)))
+
+    total_counts = collections.Counter()
+    for shard_name in shard_names:
+        merge_counts(total_counts, read_json(os.path.join(work_dir, RESULTS, shard_name)))
+
+    if output_path is not None:
+        with open(output_path, 'wb') as output_file:
+            for shard_name in shard_names:
+                with open(os.path.join(work_dir, RESULTS, _tagged_name(shard_name)), 'rb') as tagged_file:
+                    output_file.write(tagged_file.read())
+    return total_counts
+
+
+def reduce_memory_profiles(work_dir):
+    """Returns a MemoryProfiler holding the memory records of every shard
+    that was tagged with memory profiling on."""
+
+    profiler = MemoryProfiler()
+    for shard_name in read_json(os.path.join(work_dir, "shards.json"), default=[]):
+        profile = read_json(os.path.join(work_dir, RESULTS, _memory_name(shard_name)))
+        if profile is not None:
+            profiler.records.extend(profile['documents'])
+    return profiler
+
+
+class Worker(object):
+    """Claims shards from a work directory and tags them until none are left."""
+
+    #The most seconds an idle worker waits before looking at the claims again.
+    poll_seconds = 1.0
+
+    def __init__(self, work_dir, worker_id=None, lease_seconds=300, tag_function=tag_text, profile_memory=False):
+        """If profile_memory is True, documents are tagged with a MemoryProfiler
+        instead of tag_function, and the records for each shard are written
+        to the results folder."""
+
+        self.work_dir = work_dir
+        self.worker_id = worker_id or "%s-%d" % (socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.tag_function = tag_function
+        self.profiler = MemoryProfiler() if profile_memory else None
+        if self.profiler is not None:
+            self.tag_function = self.profiler.tag_text
+
+    def run(self):
+        """Tags shards until pending and claimed are both empty. While other
+        workers still hold claims, this keeps checking for claims that have
+        expired, at least four times per lease, so the shards of a worker
+        that died are tagged again. Returns the names of the shards this
+        worker finished."""
+
+        finished = []
+        while True:
+            claim = self.claim()
+            if claim is not None:
+                shard_name, claim_path = claim
+                if self.tag_shard(shard_name, claim_path):
+                    finished.append(shard_name)
+                continue
+            if requeue_expired(self.work_dir, self.lease_seconds):
+                continue
+            if not os.listdir(os.path.join(self.work_dir, CLAIMED)):
+                return finished
+            time.sleep(min(self.lease_seconds / 4.0, Worker.poll_seconds))
+
+    def claim(self):
+        """Returns the shard name and claim path of the next unclaimed shard,
+        or None if there are none."""
+
+        pending_dir = os.path.join(self.work_dir, PENDING)
+        for shard_name in sorted(os.listdir(pending_dir)):
+            if not shard_name.endswith(".json"):
+                continue
+            claim_path = os.path.join(self.work_dir, CLAIMED, "%s@%s" % (shard_name, self.worker_id))
+            try:
+                os.rename(os.path.join(pending_dir, shard_name), claim_path)
+                os.utime(claim_path, None)
+            except OSError:
+                #Another worker claimed it first.
+                continue
+            return shard_name, claim_path
+        return None
+
+    def tag_shard(self, shard_name, claim_path):
+        """Tags one claimed shard and writes its results. Returns False if the
+        lease was lost because the claim was requeued by another process, or
+        if tagging failed, in which case the shard is moved to the results
+        folder with the error so it is not claimed again."""
+
+        try:
+            with io.open(claim_path, 'r', encoding='utf-8') as shard_file:
+                shard = json.load(shard_file)
+        except (IOError, OSError):
+            #The claim was requeued between claiming it and reading it.
+            return False
+
+        lease_lost = threading.Event()
+        shard_done = threading.Event()
+
+        def renew_lease():
+            #Renewing from a thread keeps the lease even while one long document is tagged.
+            while not shard_done.wait(self.lease_seconds / 4.0):
+                try:
+                    os.utime(claim_path, None)
+                except OSError:
+                    lease_lost.set()
+                    return
+
+        heartbeat = threading.Thread(target=renew_lease)
+        heartbeat.daemon = True
+        heartbeat.start()
+        if self.profiler is not None:
+            self.profiler.records = []
+        try:
+            total_counts = collections.Counter()
+            tagged_lines = []
+            for doc_id, text in shard:
+                tagged_text, counter_tags = self.tag_function(text, use_averages=False)
+                if self.profiler is not None:
+                    self.profiler.records[-1]['document'] = doc_id
+                merge_counts(total_counts, counter_tags)
+                tagged_lines.append(json.dumps({'id': doc_id, 'tagged_text': tagged_text}).encode('utf-8') + b"\n")
+                if lease_lost.is_set():
+                    return False
+        except Exception:
+            self.record_failure(shard_name, claim_path, traceback.format_exc())
+            return False
+        finally:
+            shard_done.set()
+            heartbeat.join()
+        if lease_lost.is_set() or not os.path.exists(claim_path):
+            return False
+
+        results_dir = os.path.join(self.work_dir, RESULTS)
+        tmp_path = os.path.join(results_dir, "%s.%s.tmp" % (shard_name, self.worker_id))
+        with open(tmp_path, 'wb') as tagged_file:
+            tagged_file.write(b"".join(tagged_lines))
+        os.rename(tmp_path, os.path.join(results_dir, _tagged_name(shard_name)))
+        if self.profiler is not None:
+            self.profiler.write_json(os.path.join(results_dir, _memory_name(shard_name)))
+        #The counts file is written last because reduce_results treats it as the sign a shard is done.
+        write_json_atomic(os.path.join(results_dir, shard_name), dict(total_counts))
+        try:
+            os.remove(claim_path)
+        except OSError:
+            pass
+        return True
+
+    def record_failure(self, shard_name, claim_path, error):
+        results_dir = os.path.join(self.work_dir, RESULTS)
+        try:
+            os.rename(claim_path, os.path.join(results_dir, _failed_name(shard_name)))
+        except OSError:
+            #The lease was lost, so the shard belongs to another worker now.
+            return
+        with io.open(os.path.join(results_dir, _error_name(shard_name)), 'w', encoding='utf-8') as error_file:
+            error_file.write("Worker %s could not tag %s:\n%s" % (self.worker_id, shard_name, error))
+
+
+def run_worker(work_dir, worker_id=None, lease_seconds=300, profile_memory=False):
+    """Runs a worker. This is the target used for local worker processes."""
+
+    return Worker(work_dir, worker_id, lease_seconds, profile_memory=profile_memory).run()
+
+
+def run_local_workers(work_dir, processes=None, lease_seconds=300, profile_memory=False):
+    """Starts processes workers on this machine and waits for them to finish."""
+
+    workers = [multiprocessing.Process(target=run_worker, args=(work_dir, "local-%d" % i, lease_seconds, profile_memory))
+               for i in range(processes or multiprocessing.cpu_count())]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [worker.exitcode for worker in workers]
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author: David Wong <davidwong.xc@gmail.com>
+License: 3 clause BSD license
+
+This module contains helpers for reading and writing the files
+used when tagging text files in bulk.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import os
+
+
+def read_json(path, default=None):
+    """Returns the decoded contents of a JSON file, or default
+    if the file does not exist."""
+
+    if not os.path.exists(path):
+        return default
+    with io.open(path, 'r', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def write_json_atomic(path, data):
+    """Writes data to a JSON file. The data is written to a temporary file
+    first and then renamed, so readers never see a half written file."""
+
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'wb') as json_file:
+        json_file.write(json.dumps(data, sort_keys=True).encode('utf-8'))
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def content_hash(data):
+    """Returns the SHA-1 hex digest of a byte string."""
+
+    return hashlib.sha1(data).hexdigest()
@@ -60,32 +60,117 @@ class FullResultsWindow(wx.Frame):
                       'Existential there': 'EX', 'Foreign Word': 'FW', 'Preposition or Subordinating Conjunction': 'IN',
                       'Adjective': 'JJ', 'Adjective, comparative': 'JJR', 'Adjective, superlative': 'JJS',
                       'List item marker': 'LS', 'Modal': 'MD', 'Noun, singular or mass': 'NN', 'Noun, plural': 'NNS',
-                      'Proper noun, singular': 'NNPS', 'Proper noun, plural': 'NNPS', 'Predeterminer': 'PDT', 'Possessive ending': 'POS',
+                      'Proper noun, singular': 'NNP', 'Proper noun, plural': 'NNPS', 'Predeterminer': 'PDT', 'Possessive ending': 'POS',
                       'Personal pronoun': 'PRP', 'Possessive pronoun':'PRP$', 'Adverb': 'RB', 'Adverb, comparative': 'RBR',
                       'Adverb, superlative': 'RBS', 'Particle': 'RP', 'Symbol': 'SYM', 'To': 'TO', 'Interjection': 'UH',
-                      'Verb, base form': 'VB', 'Verb, past tense': 'VBD', 'Verb, gerund or present participle': 'VBG', 'VBN': 'Verb, past participle',
+                      'Verb, base form': 'VB', 'Verb, past tense': 'VBD', 'Verb, gerund or present participle': 'VBG', 'Verb, past participle': 'VBN',
                       'Verb, non-3rd person singular present': 'VBP', 'Verb, 3rd person singular present': 'VBZ', 'Wh-determiner': 'WDT', 'Wh-pronoun': 'WP',
                       'Possessive wh-pronoun': 'WP$', 'Wh-adverb': 'WRB'})
     
     def __init__(self, counter_tags, *args, **kwargs):
         super(FullResultsWindow, self).__init__(*args, **kwargs)
-        self.window = wx.ScrolledWindow(self)
-        self.fullresults_sizer = wx.FlexGridSizer(rows=38, cols=2, vgap=3, hgap=5)
-        self.set_results(counter_tags)
-        self.window.SetSizer(self.fullresults_sizer)
-        self.window.SetScrollRate(5, 5)
+        self.results_list = ResultsListCtrl(self)
+        rows = [(i, FullResultsWindow.tags_dict[i], FullResultsWindow.tags_dict[i]) for i in sorted(FullResultsWindow.tags_dict)]
+        rows.extend([('Words', '', 'words'), ('Sentences', '', 'sentences')])
+        self.results_list.set_rows(rows)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+        self.counter_tags = counter_tags
+        self.refresh()
         
-    
     def set_results(self, counter_tags):
-        self.fullresults_sizer.Clear(deleteWindows=True)
-        wordclass_list = sorted(FullResultsWindow.tags_dict.iterkeys())
-        for i in wordclass_list:
-            self.fullresults_sizer.Add(wx.StaticText(self.window, label=' '.join([i, FullResultsWindow.tags_dict[i]])))
-            self.fullresults_sizer.Add(wx.StaticText(self.window, label="%g" % counter_tags[FullResultsWindow.tags_dict[i]]))
-        self.fullresults_sizer.Add(wx.StaticText(self.window, label='Words'))
-        self.fullresults_sizer.Add(wx.StaticText(self.window, label="%g" % counter_tags['words']))
-        self.fullresults_sizer.Add(wx.StaticText(self.window, label='Sentences'))
-        self.fullresults_sizer.Add(wx.StaticText(self.window, label="%g" % counter_tags['sentences']))
+        """Stores new results. The list is only redrawn now if the window is
+        showing, otherwise it is redrawn the next time it is shown."""
+        
+        self.counter_tags = counter_tags
+        self.dirty = True
+        if self.IsShown():
+            self.refresh()
+            
+    def refresh(self):
+        self.results_list.set_counts(self.counter_tags)
+        self.dirty = False
+        
+    def show_results(self):
+        if self.dirty:
+            self.refresh()
+        self.Center()
+        self.Show()
+        self.Raise()
+        
+    def on_close(self, evt):
+        """Hides the window instead of destroying it so it can be reused."""
+        
+        if evt.CanVeto():
+            self.Hide()
+            evt.Veto()
+        else:
+            self.Destroy()
+        
+        
+class ResultsListCtrl(wx.ListCtrl):
+    """A virtual list of part of speech counts. Rows are only drawn when they are
+    scrolled into view, so large tagsets cost nothing extra to update. Clicking
+    a column header sorts by that column, clicking it again reverses the order."""
+    
+    def __init__(self, parent):
+        super(ResultsListCtrl, self).__init__(parent, style=wx.LC_REPORT|wx.LC_VIRTUAL|wx.LC_SINGLE_SEL)
+        self.InsertColumn(0, "Part of Speech", width=300)
+        self.InsertColumn(1, "Tag", width=60)
+        self.InsertColumn(2, "Count", width=80)
+        self.rows = []
+        self.known_keys = set()
+        self.counter_tags = {}
+        self.sort_column = None
+        self.sort_reverse = False
+        self.Bind(wx.EVT_LIST_COL_CLICK, self.on_column_click)
+        
+    def set_rows(self, rows):
+        """rows is a list of (label, tag, key) tuples, where key is the key of
+        the row's count in the results."""
+        
+        self.rows = list(rows)
+        self.known_keys = set(i[2] for i in self.rows)
+        self.SetItemCount(len(self.rows))
+    
+    def set_counts(self, counter_tags):
+        """Updates the counts shown. Tags that are not already in the list
+        are added to the end of it."""
+        
+        self.counter_tags = counter_tags
+        new_keys = sorted(i for i in counter_tags if i not in self.known_keys)
+        if new_keys:
+            self.rows.extend((i, i, i) for i in new_keys)
+            self.known_keys.update(new_keys)
+            self.SetItemCount(len(self.rows))
+        if self.sort_column is not None:
+            self.sort_rows()
+        self.refresh_rows()
+        
+    def sort_rows(self):
+        if self.sort_column == 2:
+            sort_key = lambda row: self.counter_tags.get(row[2], 0)
+        else:
+            sort_key = lambda row: row[self.sort_column].lower()
+        self.rows.sort(key=sort_key, reverse=self.sort_reverse)
+    
+    def refresh_rows(self):
+        if self.rows:
+            self.RefreshItems(0, len(self.rows) - 1)
+        
+    def on_column_click(self, evt):
+        column = evt.GetColumn()
+        self.sort_reverse = column == self.sort_column and not self.sort_reverse
+        self.sort_column = column
+        self.sort_rows()
+        self.refresh_rows()
+        
+    def OnGetItemText(self, item, column):
+        label, tag, key = self.rows[item]
+        if column == 0:
+            return label
+        elif column == 1:
+            return tag
+        return "%g" % self.counter_tags.get(key, 0)
         
             
 class FileDialog(object):
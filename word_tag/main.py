@@ -283,10 +283,9 @@ class MainWindow(wx.Frame):
                                                                      use_averages=self.rb_averages_persentence.GetValue())
         self.textbox_main.ChangeValue(MainWindow._tagged_text)
         self.set_resultbox(MainWindow._counter_tags)
-        if hasattr(MainWindow, "fullresults_window"):
+        #The full results window is built the first time it is shown.
+        if hasattr(self, "fullresults_window"):
             self.fullresults_window.set_results(MainWindow._counter_tags)
-        else:
-            self.fullresults_window = FullResultsWindow(MainWindow._counter_tags, parent=self, title="Full Results")
                                                         
         
         
@@ -327,13 +326,9 @@ class MainWindow(wx.Frame):
         """Shows the full results window, which includes all parts of speech
         in the Penn Treebank tagset.""" 
         
-        if hasattr(MainWindow, "fullresults_window"):
-            pass
-        else:
+        if not hasattr(self, "fullresults_window"):
             self.fullresults_window = FullResultsWindow(MainWindow._counter_tags, parent=self, title="Full Results")
-        self.fullresults_window.Center()
-        self.fullresults_window.Show()
-        self.fullresults_window.Raise()
+        self.fullresults_window.show_results()
         
         
     def on_exit(self, evt):
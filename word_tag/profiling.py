@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author: David Wong <davidwong.xc@gmail.com>
+License: 3 clause BSD license
+
+This module contains a memory profiler for text tagging. It records the
+memory used by each stage of tag_text for every document, and fits the peak
+memory against document length so the memory needed for a new workload
+can be estimated.
+
+Allocation tracing uses the tracemalloc module, which needs Python 3.4 or
+later, and peaks for each stage need Python 3.9 or later. Current resident
+memory is read from /proc, so it is only recorded on Linux. The process's
+peak resident memory comes from the resource module, which is not available
+on Windows. Figures that cannot be measured are left out.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from word_tag.business import tokenize_text, tag_tokens, count_tags, join_tagged_tokens
+from word_tag.fileutils import write_json_atomic
+
+
+def rss_bytes():
+    """Returns the current resident memory of this process, or None if it
+    is not available on this platform."""
+
+    try:
+        with open('/proc/self/statm', 'rb') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, AttributeError):
+        return None
+
+
+def process_peak_rss_bytes():
+    """Returns the highest resident memory of this process so far, or None
+    if it is not available on this platform. This only ever goes up, so it
+    says nothing about a single document once a larger one has been tagged."""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, OS X reports bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MemoryProfiler(object):
+    """Tags text the same way as business.tag_text while recording, for each
+    stage (tokenize, tag, count, join), the peak memory allocated above what
+    was in use when the stage started and the lines that allocated the most.
+    A profiler's tag_text method can be passed to batch runners that accept
+    a tag_function."""
+
+    def __init__(self, top_sites=5):
+        self.top_sites = top_sites
+        self.records = []
+        self.warmed_up = False
+
+    def warm_up(self):
+        """Tags a short text so NLTK loads its tokenizer and tagger models,
+        which are loaded lazily on first use, before anything is measured."""
+
+        tag_tokens(tokenize_text("This loads the models."))
+        self.warmed_up = True
+
+    def tag_text(self, text, use_averages):
+        if not self.warmed_up:
+            self.warm_up()
+        record = {'document': len(self.records), 'chars': len(text), 'stages': {}}
+        tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+
+        try:
+            tokens = self.run_stage(record, 'tokenize', tokenize_text, text)
+            tagged_tokens = self.run_stage(record, 'tag', tag_tokens, tokens)
+            counter_tags = self.run_stage(record, 'count', count_tags, tagged_tokens, use_averages)
+            tagged_text = self.run_stage(record, 'join', join_tagged_tokens, tagged_tokens)
+        finally:
+            if tracing:
+                tracemalloc.stop()
+
+        record['rss_bytes'] = rss_bytes()
+        record['process_peak_rss_bytes'] = process_peak_rss_bytes()
+        self.records.append(record)
+        return tagged_text, counter_tags
+
+    def run_stage(self, record, stage, function, *args):
+        stage_record = {}
+        if tracemalloc is not None:
+            snapshot_before = tracemalloc.take_snapshot()
+            traced_before = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+        start_time = time.time()
+        result = function(*args)
+        stage_record['seconds'] = time.time() - start_time
+
+        if tracemalloc is not None:
+            traced, peak = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                #Without reset_peak the peak would include earlier stages, so it is only kept per document.
+                stage_record['peak_bytes'] = peak - traced_before
+            stage_record['net_bytes'] = traced - traced_before
+            record['peak_traced_bytes'] = max(record.get('peak_traced_bytes', 0), peak)
+            #Leave out allocations made by tracemalloc and by the profiler itself.
+            ignore_profiler = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            snapshot = tracemalloc.take_snapshot().filter_traces(ignore_profiler)
+            allocations = [i for i in snapshot.compare_to(snapshot_before.filter_traces(ignore_profiler), 'lineno')
+                           if i.size_diff > 0]
+            stage_record['top_sites'] = [{'site': "%s:%d" % (i.traceback[0].filename, i.traceback[0].lineno),
+                                          'size_bytes': i.size_diff, 'count': i.count_diff}
+                                         for i in allocations[:self.top_sites]]
+        record['stages'][stage] = stage_record
+        return result
+
+    def summary(self):
+        """Fits peak memory against document length with least squares. Returns
+        the bytes per input character and the fixed bytes per document, so
+        the memory needed for a document of n characters is about
+        fixed_bytes + bytes_per_char * n."""
+
+        summary = {'documents': len(self.records)}
+        points = [(i['chars'], i['peak_traced_bytes']) for i in self.records if 'peak_traced_bytes' in i]
+        if points:
+            summary['peak_traced_bytes'] = dict(zip(('bytes_per_char', 'fixed_bytes'), self.fit_line(points)))
+            summary['peak_traced_bytes']['max'] = max(i[1] for i in points)
+        rss = [i['process_peak_rss_bytes'] for i in self.records if i.get('process_peak_rss_bytes') is not None]
+        if rss:
+            summary['process_peak_rss_bytes'] = max(rss)
+        return summary
+
+    @staticmethod
+    def fit_line(points):
+        """Returns the slope and intercept of the least squares line through points."""
+
+        count = float(len(points))
+        mean_x = sum(i[0] for i in points) / count
+        mean_y = sum(i[1] for i in points) / count
+        variance = sum((i[0] - mean_x) ** 2 for i in points)
+        if variance == 0:
+            return 0.0, mean_y
+        slope = sum((i[0] - mean_x) * (i[1] - mean_y) for i in points) / variance
+        return slope, mean_y - slope * mean_x
+
+    def write_json(self, path):
+        write_json_atomic(path, {'documents': self.records, 'summary': self.summary()})
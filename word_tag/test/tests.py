@@ -10,9 +10,39 @@ the part of speech number of occurrences counting.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import collections
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+from word_tag import watch
+from word_tag.batch import CorpusJob, BatchScheduler, make_work_units
 from word_tag.business import tag_text
+from word_tag.profiling import MemoryProfiler
+from word_tag.distributed import (write_shards, reduce_results, reduce_memory_profiles, requeue_expired,
+                                  run_local_workers, Worker)
+from word_tag.watch import FolderWatcher
+
+#(document id, text) pairs shared by the bulk tagging tests.
+DOCUMENTS = [(1, "He likes to read books about expressive languages."),
+             (2, "The sea otter swam in the sea for a while."),
+             (3, "It slowly drifted on the waves, eating a clam that it had found."),
+             (4, "She likes to write books.")]
+
+
+def expected_counts(*texts):
+    """Returns the tag counts of texts tagged one at a time and added up,
+    which is what every bulk runner should report."""
+    
+    totals = collections.Counter()
+    for text in texts:
+        totals.update(tag_text(text=text, use_averages=False)[1])
+    return +totals
+
 
 class TestTagging(unittest.TestCase):
     """Part of speech tagging sometimes differs
@@ -88,7 +118,288 @@ class TestTagging(unittest.TestCase):
         self.assertEqual(counter_tags['sentences'], 2)
         
 
-         
+
+class TestFolderWatcher(unittest.TestCase):
+    """Tests that syncing a folder only tags new or changed files
+    and keeps the corpus totals correct."""
+    
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sentence = DOCUMENTS[0][1]
+        self.paragraph = DOCUMENTS[1][1] + " " + DOCUMENTS[2][1]
+        self.write_file("a.txt", self.sentence)
+        self.write_file("b.txt", self.paragraph)
+        
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        
+    def write_file(self, name, text):
+        with io.open(os.path.join(self.folder, name), 'w', encoding='utf-8') as text_file:
+            text_file.write(text)
+        
+    def test_sync(self):
+        watcher = FolderWatcher(self.folder)
+        result = watcher.sync()
+        self.assertEqual(result.added, ["a.txt", "b.txt"])
+        self.assertEqual(+watcher.total_counts, expected_counts(self.sentence, self.paragraph))
+        
+        result = FolderWatcher(self.folder).sync()
+        self.assertEqual(result.added + result.changed + result.removed, [])
+        self.assertEqual(result.unchanged, ["a.txt", "b.txt"])
+        
+    def test_sync_changed_and_removed(self):
+        FolderWatcher(self.folder).sync()
+        self.write_file("a.txt", self.sentence + " She likes to write books.")
+        os.utime(os.path.join(self.folder, "a.txt"), (0, 0))
+        os.remove(os.path.join(self.folder, "b.txt"))
+        
+        watcher = FolderWatcher(self.folder)
+        result = watcher.sync()
+        self.assertEqual(result.changed, ["a.txt"])
+        self.assertEqual(result.removed, ["b.txt"])
+        self.assertEqual(+watcher.total_counts, expected_counts(self.sentence + " She likes to write books."))
+        
+    def test_output_folder_inside_watched_folder(self):
+        watcher = FolderWatcher(self.folder, output_folder=os.path.join(self.folder, "tagged"))
+        self.assertEqual(watcher.sync().added, ["a.txt", "b.txt"])
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "tagged", "a.txt")))
+        self.assertEqual(watcher.sync().added, [])
+        self.assertEqual(+watcher.total_counts, expected_counts(self.sentence, self.paragraph))
+        
+    def test_tagging_error(self):
+        def tag_or_fail(text, use_averages):
+            if text == self.paragraph:
+                raise ValueError("tagging failed")
+            return tag_text(text, use_averages)
+        
+        result = FolderWatcher(self.folder, tag_function=tag_or_fail).sync()
+        self.assertEqual(result.added, ["a.txt"])
+        self.assertEqual(result.failed, ["b.txt"])
+        
+        result = FolderWatcher(self.folder).sync()
+        self.assertEqual(result.added, ["b.txt"])
+        self.assertEqual(result.unchanged, ["a.txt"])
+        
+    def test_unreadable_file(self):
+        watcher = FolderWatcher(self.folder)
+        watcher.sync()
+        self.write_file("a.txt", self.sentence + " She likes to write books.")
+        os.utime(os.path.join(self.folder, "a.txt"), (0, 0))
+        
+        def locked_open(path, mode='r'):
+            raise IOError(13, "Permission denied", path)
+        
+        #A file that exists but cannot be opened, as when another program has it locked.
+        watch.open = locked_open
+        try:
+            result = watcher.sync()
+        finally:
+            del watch.open
+        self.assertEqual(result.failed, ["a.txt"])
+        self.assertEqual(result.removed, [])
+        self.assertEqual(+watcher.total_counts, expected_counts(self.sentence, self.paragraph))
+        
+        result = watcher.sync()
+        self.assertEqual(result.changed, ["a.txt"])
+        self.assertEqual(+watcher.total_counts, expected_counts(self.sentence + " She likes to write books.",
+                                                               self.paragraph))
+        
+
+class TestCorpusJob(unittest.TestCase):
+    """Tests that a corpus job resumes from its last checkpoint
+    without tagging or counting any document twice."""
+    
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.folder, "tagged.jsonl")
+        self.documents = DOCUMENTS[:3]
+        
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        
+    def interrupted_documents(self):
+        for document in self.documents:
+            yield document
+        raise KeyboardInterrupt
+    
+    def test_resume(self):
+        self.assertRaises(KeyboardInterrupt, CorpusJob(self.output_path, checkpoint_every=2).run,
+                          self.interrupted_documents())
+        
+        job = CorpusJob(self.output_path, checkpoint_every=2)
+        total_counts = job.run(self.documents)
+        self.assertEqual(job.stats['documents_skipped'], 2)
+        self.assertEqual(job.stats['documents_tagged'], 1)
+        
+        self.assertEqual(+total_counts, expected_counts(*[text for doc_id, text in self.documents]))
+        with io.open(self.output_path, encoding='utf-8') as output_file:
+            self.assertEqual([json.loads(line)['id'] for line in output_file], [1, 2, 3])
+        
+    def test_resume_with_missing_ids_file(self):
+        self.assertRaises(KeyboardInterrupt, CorpusJob(self.output_path, checkpoint_every=2).run,
+                          self.interrupted_documents())
+        os.remove(self.output_path + ".checkpoint.ids")
+        
+        self.assertRaises(ValueError, CorpusJob(self.output_path, checkpoint_every=2).run, self.documents)
+        #The output is left as the interrupted run wrote it.
+        with io.open(self.output_path, encoding='utf-8') as output_file:
+            self.assertEqual([json.loads(line)['id'] for line in output_file], [1, 2, 3])
+        
+
+class TestDistributed(unittest.TestCase):
+    """Tests tagging a corpus with several local worker processes
+    sharing one work directory."""
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.documents = DOCUMENTS
+        
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+    
+    def test_local_workers(self):
+        write_shards(self.work_dir, self.documents, shard_size=1)
+        self.assertRaises(ValueError, reduce_results, self.work_dir)
+        self.assertEqual(run_local_workers(self.work_dir, processes=3), [0, 0, 0])
+        
+        output_path = os.path.join(self.work_dir, "tagged.jsonl")
+        total_counts = reduce_results(self.work_dir, output_path)
+        self.assertEqual(+total_counts, expected_counts(*[text for doc_id, text in self.documents]))
+        with io.open(output_path, encoding='utf-8') as output_file:
+            self.assertEqual([json.loads(line)['id'] for line in output_file], [1, 2, 3, 4])
+            
+    def test_requeue_expired(self):
+        write_shards(self.work_dir, self.documents, shard_size=4)
+        self.assertEqual(Worker(self.work_dir, "dead").claim()[0], "shard-000000.json")
+        self.assertEqual(requeue_expired(self.work_dir, lease_seconds=60), 0)
+        self.assertEqual(requeue_expired(self.work_dir, lease_seconds=-1), 1)
+        self.assertEqual(Worker(self.work_dir, "alive").run(), ["shard-000000.json"])
+        
+    def test_workers_wait_for_dead_worker(self):
+        write_shards(self.work_dir, self.documents, shard_size=1)
+        self.assertEqual(Worker(self.work_dir, "dead").claim()[0], "shard-000000.json")
+        
+        self.assertEqual(run_local_workers(self.work_dir, processes=2, lease_seconds=2), [0, 0])
+        total_counts = reduce_results(self.work_dir)
+        self.assertEqual(+total_counts, expected_counts(*[text for doc_id, text in self.documents]))
+        
+    def test_tagging_error(self):
+        write_shards(self.work_dir, self.documents, shard_size=2)
+        def tag_or_fail(text, use_averages):
+            if text == self.documents[2][1]:
+                raise ValueError("tagging failed")
+            return tag_text(text, use_averages)
+        
+        self.assertEqual(Worker(self.work_dir, "worker", tag_function=tag_or_fail).run(), ["shard-000000.json"])
+        self.assertEqual(os.listdir(os.path.join(self.work_dir, "claimed")), [])
+        self.assertTrue(os.path.exists(os.path.join(self.work_dir, "results", "shard-000001.error")))
+        self.assertRaises(ValueError, reduce_results, self.work_dir)
+        
+        os.remove(os.path.join(self.work_dir, "results", "shard-000001.error"))
+        os.rename(os.path.join(self.work_dir, "results", "shard-000001.failed.json"),
+                  os.path.join(self.work_dir, "pending", "shard-000001.json"))
+        self.assertEqual(Worker(self.work_dir, "worker").run(), ["shard-000001.json"])
+        total_counts = reduce_results(self.work_dir)
+        self.assertEqual(+total_counts, expected_counts(*[text for doc_id, text in self.documents]))
+        
+    def test_lease_renewed_during_long_document(self):
+        write_shards(self.work_dir, self.documents[:1], shard_size=1)
+        requeued = []
+        def slow_tag_text(text, use_averages):
+            time.sleep(1)
+            requeued.append(requeue_expired(self.work_dir, lease_seconds=0.4))
+            return tag_text(text, use_averages)
+        
+        self.assertEqual(Worker(self.work_dir, "slow", lease_seconds=0.4, tag_function=slow_tag_text).run(),
+                         ["shard-000000.json"])
+        self.assertEqual(requeued, [0])
+        
+
+class TestBatchScheduler(unittest.TestCase):
+    """Tests that a batch of short and long documents is split, tagged
+    by several workers, and put back together in order."""
+    
+    def setUp(self):
+        self.long_text = " ".join(["The sea otter swam in the sea for a while."] * 10)
+        self.documents = [(1, "He likes to read books."), (2, self.long_text), (3, "She likes to write books."), (4, "")]
+        
+    def test_work_units(self):
+        units, splits = make_work_units(self.documents, unit_chars=100)
+        pieces = [piece for unit in units for piece in unit]
+        self.assertEqual(sorted(set(piece[0] for piece in pieces)), [1, 2, 3, 4])
+        self.assertEqual(list(splits), [2])
+        tokens, bounds = splits[2]
+        self.assertEqual(len(bounds), len([piece for piece in pieces if piece[0] == 2]))
+        self.assertEqual(bounds[0][0], 0)
+        self.assertEqual(bounds[-1][1], len(tokens))
+        for (start, end, left, right), (next_start, next_end, next_left, next_right) in zip(bounds, bounds[1:]):
+            self.assertEqual(end, next_start)
+    
+    def test_run(self):
+        for overlap in (2, 20):
+            scheduler = BatchScheduler(workers=2, unit_chars=60, overlap=overlap)
+            results = scheduler.run(self.documents)
+            self.assertEqual([i[0] for i in results], [1, 2, 3, 4])
+            for (doc_id, text), (result_id, tagged_text, counter_tags) in zip(self.documents, results):
+                self.assertEqual((tagged_text, counter_tags), tag_text(text=text, use_averages=False))
+            self.assertEqual(scheduler.report['split_documents'], 1)
+            self.assertEqual(sum(i['units'] for i in scheduler.report['workers']), scheduler.report['units'])
+            self.assertTrue("worker 1" in scheduler.report_text())
+            self.assertTrue(scheduler.report['split_seconds'] + scheduler.report['join_seconds']
+                            <= scheduler.report['wall_seconds'])
+    
+    def test_dead_worker(self):
+        class Process(object):
+            def __init__(self, exitcode):
+                self.exitcode = exitcode
+        
+        BatchScheduler.check_workers([Process(None), Process(0)])
+        self.assertRaises(RuntimeError, BatchScheduler.check_workers, [Process(None), Process(-9)])
+        self.assertRaises(RuntimeError, BatchScheduler.check_workers, [Process(0), Process(0)])
+        
+
+class TestMemoryProfiler(unittest.TestCase):
+    """Tests that memory profiling records each stage
+    without changing the tagging results."""
+    
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.documents = [(1, "He likes to read books."),
+                          (2, " ".join(["The sea otter swam in the sea for a while."] * 20))]
+        
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+    
+    def test_profile(self):
+        profiler = MemoryProfiler()
+        for doc_id, text in self.documents:
+            self.assertEqual(profiler.tag_text(text, use_averages=False), tag_text(text=text, use_averages=False))
+        self.assertEqual(sorted(profiler.records[0]['stages']), ['count', 'join', 'tag', 'tokenize'])
+        
+        json_path = os.path.join(self.folder, "memory.json")
+        profiler.write_json(json_path)
+        with io.open(json_path, encoding='utf-8') as json_file:
+            profile = json.load(json_file)
+        self.assertEqual(profile['summary']['documents'], 2)
+        self.assertFalse('rss_growth_bytes' in profile['summary'])
+        self.assertTrue(profiler.warmed_up)
+        
+    def test_corpus_job(self):
+        profiler = MemoryProfiler()
+        CorpusJob(os.path.join(self.folder, "tagged.jsonl"), tag_function=profiler.tag_text).run(self.documents)
+        self.assertEqual([i['chars'] for i in profiler.records], [len(text) for doc_id, text in self.documents])
+        
+    def test_distributed_workers(self):
+        write_shards(self.folder, self.documents, shard_size=1)
+        run_local_workers(self.folder, processes=2, profile_memory=True)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "results", "shard-000000.memory.json")))
+        profiler = reduce_memory_profiles(self.folder)
+        self.assertEqual(sorted(i['document'] for i in profiler.records), [1, 2])
+        
+    def test_fit_line(self):
+        self.assertEqual(MemoryProfiler.fit_line([(1, 12), (2, 14), (3, 16)]), (2.0, 10.0))
+        
+
 if __name__ == '__main__':
     unittest.main()    
         
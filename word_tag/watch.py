@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author: David Wong <davidwong.xc@gmail.com>
+License: 3 clause BSD license
+
+This module contains the folder watcher, which keeps the tag counts for a
+folder of text files up to date. A manifest records the size, modification
+time, content hash and tag counts of every file that has been tagged, so
+only new or changed files are tagged again on each sync.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import io
+import os
+import threading
+
+from word_tag.business import tag_text, merge_counts, subtract_counts
+from word_tag.fileutils import read_json, write_json_atomic, content_hash
+
+SyncResult = collections.namedtuple('SyncResult', ['added', 'changed', 'removed', 'unchanged', 'failed'])
+
+
+class FolderWatcher(object):
+    """Tags the text files in a folder and keeps corpus totals for them."""
+
+    manifest_name = ".wordtag_manifest.json"
+
+    def __init__(self, folder, manifest_path=None, output_folder=None,
+                 extensions=('.txt',), encoding='utf-8', tag_function=tag_text):
+        """manifest_path defaults to a hidden file inside folder. If output_folder
+        is given, the tagged text for each file is written there under the
+        same relative path. The output folder and the folder holding the
+        manifest are never scanned, so they can be inside folder."""
+
+        self.folder = folder
+        self.manifest_path = manifest_path or os.path.join(folder, FolderWatcher.manifest_name)
+        self.output_folder = output_folder
+        self.extensions = extensions
+        self.encoding = encoding
+        self.tag_function = tag_function
+        manifest = read_json(self.manifest_path, default={})
+        self.files = manifest.get('files', {})
+        self.total_counts = collections.Counter(manifest.get('totals', {}))
+
+    def list_files(self):
+        """Returns the paths, relative to the watched folder, of the files to tag."""
+
+        skipped_dirs = set([os.path.realpath(os.path.dirname(self.manifest_path))])
+        if self.output_folder is not None:
+            skipped_dirs.add(os.path.realpath(self.output_folder))
+        skipped_dirs.discard(os.path.realpath(self.folder))
+
+        rel_paths = []
+        for dir_path, dir_names, file_names in os.walk(self.folder):
+            dir_names[:] = sorted(i for i in dir_names if not i.startswith('.') and
+                                  os.path.realpath(os.path.join(dir_path, i)) not in skipped_dirs)
+            for file_name in sorted(file_names):
+                if os.path.splitext(file_name)[1].lower() in self.extensions:
+                    full_path = os.path.join(dir_path, file_name)
+                    rel_paths.append(os.path.relpath(full_path, self.folder).replace(os.sep, '/'))
+        return rel_paths
+
+    def sync(self):
+        """Tags new and changed files, drops removed files from the totals,
+        and saves the manifest if anything changed. Files whose size and
+        modification time match the manifest are not read at all."""
+
+        result = SyncResult(added=[], changed=[], removed=[], unchanged=[], failed=[])
+        manifest_changed = False
+        seen = set()
+
+        for rel_path in self.list_files():
+            seen.add(rel_path)
+            full_path = os.path.join(self.folder, rel_path)
+            try:
+                stat = os.stat(full_path)
+                entry = self.files.get(rel_path)
+                if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    result.unchanged.append(rel_path)
+                    continue
+                with open(full_path, 'rb') as text_file:
+                    data = text_file.read()
+            except (IOError, OSError):
+                if not os.path.exists(full_path):
+                    #Removed since the folder was listed, so it is dropped below.
+                    seen.discard(rel_path)
+                else:
+                    #Locked or unreadable, for example while it is being copied in.
+                    #Keep the old manifest entry and try again on the next sync.
+                    result.failed.append(rel_path)
+                continue
+
+            digest = content_hash(data)
+            manifest_changed = True
+            if entry is not None and entry['sha1'] == digest:
+                #Touched but not edited, so only the file details need updating.
+                entry['size'] = len(data)
+                entry['mtime'] = stat.st_mtime
+                result.unchanged.append(rel_path)
+                continue
+
+            try:
+                tagged_text, counter_tags = self.tag_function(data.decode(self.encoding, 'replace'), use_averages=False)
+            except Exception:
+                #Keep the old manifest entry so the file is tried again on the next sync.
+                result.failed.append(rel_path)
+                continue
+            if entry is not None:
+                subtract_counts(self.total_counts, entry['counts'])
+                result.changed.append(rel_path)
+            else:
+                result.added.append(rel_path)
+            merge_counts(self.total_counts, counter_tags)
+            self.files[rel_path] = {'size': len(data), 'mtime': stat.st_mtime,
+                                    'sha1': digest, 'counts': dict(counter_tags)}
+            self.write_output(rel_path, tagged_text)
+
+        for rel_path in sorted(set(self.files) - seen):
+            subtract_counts(self.total_counts, self.files.pop(rel_path)['counts'])
+            self.remove_output(rel_path)
+            result.removed.append(rel_path)
+            manifest_changed = True
+
+        if manifest_changed:
+            self.save()
+        return result
+
+    def watch(self, interval=5.0, stop_event=None, on_sync=None):
+        """Syncs the folder every interval seconds until stop_event is set.
+        on_sync is called with the SyncResult of each sync."""
+
+        if stop_event is None:
+            stop_event = threading.Event()
+        while not stop_event.is_set():
+            result = self.sync()
+            if on_sync is not None:
+                on_sync(result)
+            stop_event.wait(interval)
+
+    def save(self):
+        write_json_atomic(self.manifest_path, {'files': self.files, 'totals': dict(self.total_counts)})
+
+    def write_output(self, rel_path, tagged_text):
+        if self.output_folder is None:
+            return
+        output_path = os.path.join(self.output_folder, rel_path)
+        if not os.path.isdir(os.path.dirname(output_path)):
+            os.makedirs(os.path.dirname(output_path))
+        with io.open(output_path, 'w', encoding='utf-8') as output_file:
+            output_file.write(tagged_text)
+
+    def remove_output(self, rel_path):
+        if self.output_folder is None:
+            return
+        output_path = os.path.join(self.output_folder, rel_path)
+        if os.path.exists(output_path):
+            os.remove(output_path)